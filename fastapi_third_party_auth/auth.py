@@ -15,15 +15,31 @@ Usage
         return f"Hello {authenticated_user.preferred_username}"
 """
 
+import base64
+import binascii
+import hashlib
+import json
+import time
+from contextlib import contextmanager
 from logging import getLogger
+from threading import Lock
+from threading import Thread
+from typing import Any
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Type
+from typing import cast
 
+import jwt
+from cachetools import TTLCache
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi import Request
 from fastapi import status
+from fastapi.openapi.models import OAuth2 as OAuth2Model
 from fastapi.openapi.models import OAuthFlowAuthorizationCode
 from fastapi.openapi.models import OAuthFlowClientCredentials
 from fastapi.openapi.models import OAuthFlowImplicit
@@ -33,17 +49,71 @@ from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import HTTPBearer
 from fastapi.security import OAuth2
 from fastapi.security import SecurityScopes
-from jose import ExpiredSignatureError
-from jose import jwt
-from jose.exceptions import JWTClaimsError, JWKError, JWTError, JWSError
+from jwt.algorithms import Algorithm
+from jwt.algorithms import ECAlgorithm
+from jwt.algorithms import RSAAlgorithm
+from jwt.exceptions import InvalidKeyError
 from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
 
 from fastapi_third_party_auth import discovery
 from fastapi_third_party_auth.grant_types import GrantType
 from fastapi_third_party_auth.idtoken_types import IDToken
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
+
 logger = getLogger(__name__)
 
+# Upper bound on the number of verified tokens remembered per Auth instance
+VERIFICATION_CACHE_SIZE = 10000
+
+# Minimum number of seconds between refetches triggered by an unknown 'kid', so
+# tokens with made up key ids can't be used to hammer the auth server
+UNKNOWN_KID_REFRESH_INTERVAL = 60
+
+# Key types we can turn into public keys, indexed by the JWK 'kty' field
+JWK_ALGORITHMS: Dict[str, Type[Algorithm]] = {"RSA": RSAAlgorithm}
+# PyJWT < 2.0 can't load EC keys from a JWK, only the base class stub exists
+if ECAlgorithm.from_jwk is not Algorithm.from_jwk:
+    JWK_ALGORITHMS["EC"] = ECAlgorithm
+try:
+    # EdDSA keys, identified by their 'crv', are only supported by PyJWT >= 2.0
+    from jwt.algorithms import OKPAlgorithm
+except ImportError:
+    pass
+else:
+    JWK_ALGORITHMS["OKP"] = OKPAlgorithm
+
+# Signing algorithms each key type may be used with, so a token can't pick an
+# algorithm that doesn't match the key it names
+JWK_ALGORITHM_FAMILIES = {
+    "RSA": ("RS256", "RS384", "RS512", "PS256", "PS384", "PS512"),
+    "EC": ("ES256", "ES256K", "ES384", "ES512", "ES521"),
+    "OKP": ("EdDSA",),
+}
+
+# A JWK, its public key and the algorithms it may verify signatures with
+IndexedKey = Tuple[Dict, Any, Tuple[str, ...]]
+
+
+def _unverified_header(token: bytes) -> Dict:
+    """Decode the header segment of a JWT without verifying the signature.
+    Only the first segment is touched, the rest is left to jwt.decode.
+    """
+    header_segment = token.split(b".", 1)[0]
+    padding = b"=" * (-len(header_segment) % 4)
+    try:
+        header = json_loads(base64.urlsafe_b64decode(header_segment + padding))
+    except (binascii.Error, ValueError) as e:
+        raise jwt.DecodeError("Error decoding token headers.") from e
+
+    if not isinstance(header, dict):
+        raise jwt.DecodeError("Invalid header string: must be a json object")
+    return header
+
 
 class Auth(OAuth2):
     def __init__(
@@ -53,8 +123,13 @@ class Auth(OAuth2):
         client_id: Optional[str] = None,
         scopes: List[str] = list(),
         grant_types: List[GrantType] = [GrantType.IMPLICIT],
-        signature_cache_ttl: int = 3600,
+        signature_cache_ttl: float = 3600,
         idtoken_model: Type[IDToken] = IDToken,
+        verification_cache_ttl: int = 0,
+        authorization_url: Optional[str] = None,
+        token_url: Optional[str] = None,
+        signature_stale_ttl: int = 0,
+        discovery_retry_interval: int = 5,
     ):
         """Configure authentication :func:`auth = Auth(...) <Auth>` and then:
 
@@ -71,9 +146,22 @@ class Auth(OAuth2):
             client_id (str): (Optional) The client_id configured by your auth server.
             scopes (Dict[str, str]): (Optional) A dictionary of scopes and their descriptions.
             grant_types (List[GrantType]): (Optional) Grant types shown in docs.
-            signature_cache_ttl (int): (Optional) How many seconds your app should
+            signature_cache_ttl (float): (Optional) How many seconds your app should
                 cache the authorization server's public signatures.
             idtoken_model (Type): (Optional) The model to use for validating the ID Token.
+            verification_cache_ttl (int): (Optional) How many seconds your app should
+                remember tokens whose signature it has already verified. Disabled
+                by default.
+            authorization_url (URL): (Optional) Authorization endpoint shown in docs.
+                Looked up from the openid connect config if not given.
+            token_url (URL): (Optional) Token endpoint shown in docs. Looked up
+                from the openid connect config if not given.
+            signature_stale_ttl (int): (Optional) For how many seconds after
+                signature_cache_ttl the cached signatures may still be used while
+                they are refreshed in the background. Disabled by default.
+            discovery_retry_interval (int): (Optional) For how many seconds after
+                failing to reach the auth server requests fail right away instead
+                of trying to reach it again.
 
         Raises:
             Nothing intentional
@@ -83,56 +171,198 @@ class Auth(OAuth2):
         self.issuer = issuer
         self.client_id = client_id
         self.idtoken_model = idtoken_model
+        # Pydantic v2 validates a dict directly, v1 gets the same from parse_obj
+        self._validate_idtoken = getattr(
+            idtoken_model, "model_validate", idtoken_model.parse_obj
+        )
         self.scopes = scopes
-        
+        self.signature_cache_ttl = signature_cache_ttl
+        self.signature_stale_ttl = signature_stale_ttl
+        self.discovery_retry_interval = discovery_retry_interval
+
         self.discover = discovery.configure(cache_ttl=signature_cache_ttl)
         self.grant_types = grant_types
+        self.authorization_url = authorization_url
+        self.token_url = token_url
+
+        self._scopes_frozen = frozenset(scopes)
+        self._verify_options = {
+            "verify_iss": issuer is not None,
+            "verify_aud": client_id is not None,
+        }
+
+        self._discovery_lock = Lock()
+        self._background_refresh_lock = Lock()
+        self._auth_server_failed_at: Optional[float] = None
+        self._discovery_cache: Optional[Tuple[float, Dict]] = None
+        self._keys_cache: Dict[str, IndexedKey] = {}
+
+        self._verified_tokens_lock = Lock()
+        self._verified_tokens: Optional[TTLCache] = None
+        if verification_cache_ttl > 0:
+            self._verified_tokens = TTLCache(
+                VERIFICATION_CACHE_SIZE, verification_cache_ttl
+            )
 
-        try:
-            flows = self.get_flows()
-        except ConnectionError as e:
-            logger.warning("Could not discover OIDC flows %s", e)
-            flows = OAuthFlows()
+        super().__init__(scheme_name="OIDC", auto_error=False)
+        # Drop the placeholder model so the flows are only discovered once
+        # FastAPI builds the OpenAPI schema
+        self._model: Optional[OAuth2Model] = None
 
-        super().__init__(scheme_name="OIDC", flows=flows, auto_error=False)
+    @property  # type: ignore[override]
+    def model(self) -> OAuth2Model:
+        if self._model is None:
+            try:
+                flows = self.get_flows()
+            except (RequestException, InvalidKeyError) as e:
+                logger.warning("Could not discover OIDC flows: %s", e)
+                # Not kept, so the next schema build tries again
+                return OAuth2Model(flows=OAuthFlows())
+            self._model = OAuth2Model(flows=flows)
+
+        return self._model
+
+    @model.setter
+    def model(self, model: OAuth2Model) -> None:
+        self._model = model
+
+    def _get_discoveries(self) -> Dict:
+        """Return the OIDC discovery document, refetching it and the JWKs once
+        they are older than signature_cache_ttl seconds. For
+        signature_stale_ttl seconds after that the cached values keep being
+        served while they are refetched in the background.
+        """
+        if self._discovery_cache is not None:
+            fetched_at, oidc_discoveries = self._discovery_cache
+            age = time.monotonic() - fetched_at
+            if age < self.signature_cache_ttl:
+                return oidc_discoveries
+            if age < self.signature_cache_ttl + self.signature_stale_ttl:
+                self._refresh_in_background()
+                return oidc_discoveries
+
+        return self._refresh_discovery(self.signature_cache_ttl)
+
+    def _refresh_discovery(self, max_age: float, clear_cache: bool = False) -> Dict:
+        """Refetch the OIDC discovery document and JWKs unless they were fetched
+        less than max_age seconds ago. The signing algorithms and the kid index
+        are derived on each refetch rather than on each request, and only
+        replace the current ones once everything was fetched successfully.
+        """
+        with self._discovery_lock:
+            # Another thread may have refetched while we waited for the lock
+            if self._discovery_cache is not None:
+                fetched_at, oidc_discoveries = self._discovery_cache
+                if time.monotonic() - fetched_at < max_age:
+                    return oidc_discoveries
+
+            if clear_cache:
+                self.discover.clear_cache()
+            with self._auth_server_breaker():
+                oidc_discoveries = self.discover.auth_server(
+                    openid_connect_url=self.openid_connect_url
+                )
+            algorithms = tuple(self.discover.signing_algos(oidc_discoveries))
+            keys_by_kid = self._index_keys(oidc_discoveries, algorithms)
+
+            self._keys_cache = keys_by_kid
+            self._discovery_cache = (time.monotonic(), oidc_discoveries)
+            return oidc_discoveries
+
+    @contextmanager
+    def _auth_server_breaker(self) -> Iterator[None]:
+        """Fail right away if the auth server could not be reached in the last
+        discovery_retry_interval seconds, so an outage doesn't make every
+        request wait on a new connection attempt.
+        """
+        failed_at = self._auth_server_failed_at
+        if (
+            failed_at is not None
+            and time.monotonic() - failed_at < self.discovery_retry_interval
+        ):
+            raise ConnectionError("Auth server was recently unreachable")
+
+        try:
+            yield
+        except RequestException as e:
+            self._auth_server_failed_at = time.monotonic()
+            logger.warning("Could not reach auth server: %s", e)
+            raise
+        self._auth_server_failed_at = None
+
+    def _refresh_in_background(self) -> None:
+        if self._background_refresh_lock.acquire(blocking=False):
+            Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self) -> None:
+        try:
+            self._refresh_discovery(self.signature_cache_ttl)
+        except RequestException:
+            # Already logged by _auth_server_breaker
+            pass
+        except Exception as e:
+            logger.warning("Could not refresh OIDC discovery: %s", e)
+        finally:
+            self._background_refresh_lock.release()
 
     def get_flows(self) -> OAuthFlows:
-        oidc_discoveries = self.discover.auth_server(
-            openid_connect_url=self.openid_connect_url
+        authorization_url = self.authorization_url
+        token_url = self.token_url
+        grant_types = set(self.grant_types)
+
+        needs_authorization_url = authorization_url is None and (
+            GrantType.AUTHORIZATION_CODE in grant_types
+            or GrantType.IMPLICIT in grant_types
+        )
+        needs_token_url = token_url is None and (
+            GrantType.AUTHORIZATION_CODE in grant_types
+            or GrantType.CLIENT_CREDENTIALS in grant_types
+            or GrantType.PASSWORD in grant_types
         )
+        if needs_authorization_url or needs_token_url:
+            oidc_discoveries = self._get_discoveries()
+            if needs_authorization_url:
+                authorization_url = self.discover.authorization_url(oidc_discoveries)
+            if needs_token_url:
+                token_url = self.discover.token_url(oidc_discoveries)
+        # Whichever URLs the configured grant types use are set by now
+        authorization_url = cast(str, authorization_url)
+        token_url = cast(str, token_url)
         # scopes_dict = {
         #     scope: "" for scope in self.discover.supported_scopes(oidc_discoveries)
         # }
 
         flows = OAuthFlows()
-        if GrantType.AUTHORIZATION_CODE in self.grant_types:
+        if GrantType.AUTHORIZATION_CODE in grant_types:
             flows.authorizationCode = OAuthFlowAuthorizationCode(
-                authorizationUrl=self.discover.authorization_url(oidc_discoveries),
-                tokenUrl=self.discover.token_url(oidc_discoveries),
+                authorizationUrl=authorization_url,
+                tokenUrl=token_url,
                 # scopes=scopes_dict,
             )
 
-        if GrantType.CLIENT_CREDENTIALS in self.grant_types:
+        if GrantType.CLIENT_CREDENTIALS in grant_types:
             flows.clientCredentials = OAuthFlowClientCredentials(
-                tokenUrl=self.discover.token_url(oidc_discoveries),
+                tokenUrl=token_url,
                 # scopes=scopes_dict,
             )
 
-        if GrantType.PASSWORD in self.grant_types:
+        if GrantType.PASSWORD in grant_types:
             flows.password = OAuthFlowPassword(
-                tokenUrl=self.discover.token_url(oidc_discoveries),
+                tokenUrl=token_url,
                 # scopes=scopes_dict,
             )
 
-        if GrantType.IMPLICIT in self.grant_types:
+        if GrantType.IMPLICIT in grant_types:
             flows.implicit = OAuthFlowImplicit(
-                authorizationUrl=self.discover.authorization_url(oidc_discoveries),
+                authorizationUrl=authorization_url,
                 # scopes=scopes_dict,
             )
-        
+
         return flows
 
     async def __call__(self, request: Request) -> None:
+        # Kept async on purpose: FastAPI awaits coroutine dependencies inline
+        # but dispatches plain functions to its threadpool, which costs more.
         return None
 
     def required(
@@ -200,31 +430,132 @@ class Auth(OAuth2):
         )
 
 
-    def _find_key(self, token: str) -> dict:
-        oidc_discoveries = self.discover.auth_server(
-            openid_connect_url=self.openid_connect_url
-        )
+    @property
+    def _keys_by_kid(self) -> Dict[str, IndexedKey]:
+        """The authorization server's JWKs, their public keys and the signing
+        algorithms each may be used with, indexed by 'kid'.
+        """
+        # Refetches the discovery document and the kid index when they expire
+        self._get_discoveries()
+        return self._keys_cache
+
+    def _index_keys(
+        self, oidc_discoveries: Dict, algorithms: Tuple[str, ...]
+    ) -> Dict[str, IndexedKey]:
+        """Fetch the JWKs and index them by 'kid'. JWKs of a key type or curve
+        we can't verify signatures with, or that fail to load, are left out.
+        """
         try:
-            keys = self.discover.public_keys(oidc_discoveries)["keys"]
+            with self._auth_server_breaker():
+                keys = self.discover.public_keys(oidc_discoveries)["keys"]
         except KeyError as e:
-            raise JWKError("Badly formed JWKs_uri") from e
+            raise InvalidKeyError("Badly formed JWKs_uri") from e
+
+        keys_by_kid = {}
+        for key in keys:
+            try:
+                kid = key["kid"]
+            except KeyError as e:
+                raise InvalidKeyError("field 'kid' is missing from JWK") from e
+            algorithm = JWK_ALGORITHMS.get(key.get("kty"))
+            if algorithm is None:
+                continue
+            try:
+                public_key = algorithm.from_jwk(json.dumps(key))
+            except (InvalidKeyError, NotImplementedError, ValueError, TypeError) as e:
+                logger.warning("Ignoring JWK 'kid'=%s: %s", kid, e)
+                continue
+
+            family = JWK_ALGORITHM_FAMILIES[key["kty"]]
+            key_algorithms = tuple(alg for alg in algorithms if alg in family)
+            if "alg" in key:
+                # A JWK that declares its algorithm may only be used with it
+                key_algorithms = (
+                    (key["alg"],) if key["alg"] in key_algorithms else ()
+                )
+            keys_by_kid[kid] = (key, public_key, key_algorithms)
+
+        return keys_by_kid
 
-        header = jwt.get_unverified_header(token)
+    def _find_key(self, token: bytes) -> IndexedKey:
+        header = _unverified_header(token)
         try:
-            kid = header['kid']
+            kid = header["kid"]
         except KeyError as e:
-            raise JWTError("field 'kid' is missing from JWT headers") from e
+            raise jwt.InvalidTokenError(
+                "field 'kid' is missing from JWT headers"
+            ) from e
+        if not isinstance(kid, str):
+            raise jwt.InvalidTokenError("field 'kid' in JWT headers must be a string")
+
+        try:
+            return self._keys_by_kid[kid]
+        except KeyError:
+            pass
+
+        # The auth server may have rotated its keys since we last looked
+        self._refresh_discovery(UNKNOWN_KID_REFRESH_INTERVAL, clear_cache=True)
+        try:
+            return self._keys_by_kid[kid]
+        except KeyError as e:
+            raise jwt.InvalidTokenError(f"Could not find JWK 'kid'={kid}") from e
+
+    def _decode_token(self, token: bytes) -> Dict:
+        try:
+            jwk, key, algorithms = self._find_key(token)
+            if not algorithms:
+                raise jwt.InvalidAlgorithmError(
+                    f"JWK 'kid'={jwk['kid']} can't be used with any supported alg"
+                )
 
-        for key in keys:
             try:
-                key_kid = key['kid']
-            except KeyError as e:
-                raise JWKError("field 'kid' is missing from JWK") from e
-            if key_kid == kid:
-                return key
-        
-        raise JWKError(f"Could not find JWK 'kid'={kid}")
+                id_token = jwt.decode(
+                    token,
+                    key,
+                    algorithms=list(algorithms),
+                    issuer=self.issuer,
+                    audience=self.client_id,
+                    # A copy, so jwt.decode can't change the shared options
+                    options=dict(self._verify_options),
+                )
+            except jwt.PyJWTError as error:
+                # Anything PyJWT rejects here is down to the token, including
+                # InvalidKeyError which isn't an InvalidTokenError
+                raise jwt.InvalidTokenError(str(error)) from error
+
+            aud = id_token.get("aud")
+            if isinstance(aud, list) and len(aud) >= 1 and "azp" not in id_token:
+                raise jwt.InvalidTokenError(
+                    'Missing authorized party "azp" in IDToken when there '
+                    "are multiple audiences"
+                )
 
+        except RequestException as e:
+            raise HTTPException(503, detail="Could not reach auth server") from e
+        except jwt.InvalidTokenError as error:
+            raise HTTPException(status_code=401, detail=f"Unauthorized: {error}")
+
+        return id_token
+
+    def _verify_token(self, token: bytes) -> Dict:
+        """Decode the token, skipping signature verification if the same token
+        was verified within verification_cache_ttl seconds. Tokens are
+        remembered by their SHA-256 digest so no credentials are kept around.
+        """
+        if self._verified_tokens is None:
+            return self._decode_token(token)
+
+        cache_key = hashlib.sha256(token).digest()
+        with self._verified_tokens_lock:
+            id_token = self._verified_tokens.get(cache_key)
+        if id_token is not None and id_token["exp"] > time.time():
+            return id_token
+
+        id_token = self._decode_token(token)
+        if "exp" in id_token:
+            with self._verified_tokens_lock:
+                self._verified_tokens[cache_key] = id_token
+        return id_token
 
     def authenticate_user(
         self,
@@ -260,54 +591,20 @@ class Auth(OAuth2):
             else:
                 return None
         
-        try:
-            oidc_discoveries = self.discover.auth_server(
-                openid_connect_url=self.openid_connect_url
-            )
-        except ConnectionError as e:
-            logger.warning("Could not reach auth server %e", e)
-            raise HTTPException(503, detail="Could not reach auth server") from e
-        algorithms = self.discover.signing_algos(oidc_discoveries)
-        key = self._find_key(authorization_credentials.credentials)
-
-        try:
-            id_token = jwt.decode(
-                authorization_credentials.credentials,
-                key,
-                algorithms,
-                issuer=self.issuer,
-                audience=self.client_id,
-                options={
-                    # Disabled at_hash check since we aren't using the access token
-                    "verify_at_hash": False,
-                    "verify_iss": self.issuer is not None,
-                    "verify_aud": self.client_id is not None,
-                },
-            )
-
-            if (
-                "aud" in id_token
-                and type(id_token["aud"]) == list
-                and len(id_token["aud"]) >= 1
-                and "azp" not in id_token
-            ):
-                raise JWTError(
-                    'Missing authorized party "azp" in IDToken when there '
-                    "are multiple audiences"
-                )
-
-        except (ExpiredSignatureError, JWTError, JWTClaimsError) as error:
-            raise HTTPException(status_code=401, detail=f"Unauthorized: {error}")
+        # Encoded once here, PyJWT takes the bytes as they are
+        id_token = self._verify_token(authorization_credentials.credentials.encode())
 
-        expected_scopes = set(self.scopes + security_scopes.scopes)
-        token_scopes = id_token.get("scope", "").split(" ")
+        expected_scopes = self._scopes_frozen
+        if security_scopes.scopes:
+            expected_scopes = expected_scopes.union(security_scopes.scopes)
+        token_scopes = frozenset(id_token.get("scope", "").split())
         if not expected_scopes.issubset(token_scopes):
             raise HTTPException(
                 status.HTTP_401_UNAUTHORIZED,
                 detail=(
-                    f"Missing scope token, expected {expected_scopes} to be a "
-                    f"subset of received {token_scopes}",
+                    f"Missing scope token, expected {sorted(expected_scopes)} to "
+                    f"be a subset of received {sorted(token_scopes)}"
                 ),
             )
 
-        return self.idtoken_model(**id_token)
+        return self._validate_idtoken(id_token)
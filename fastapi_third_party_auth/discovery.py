@@ -1,19 +1,51 @@
 from typing import Dict
+from typing import Optional
 import requests
+from requests.adapters import HTTPAdapter
 from cachetools import TTLCache
 from cachetools import cached
 from threading import Lock
 
 
-def configure(*_, cache_ttl: int):
-    @cached(TTLCache(1, cache_ttl), key=lambda d: d["jwks_uri"], lock=Lock())
+def _pooled_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by every configuration so refreshes reuse open connections to the
+# authentication server instead of doing a new TLS handshake each time
+default_session = _pooled_session()
+
+# Seconds to wait on the authentication server, so an unreachable host fails
+# the fetch (and trips the caller's back off) instead of hanging the request
+default_timeout = 5.0
+
+
+def configure(
+    *_,
+    cache_ttl: float,
+    session: Optional[requests.Session] = None,
+    timeout: float = default_timeout,
+):
+    if session is None:
+        session = default_session
+
+    public_keys_cache: TTLCache = TTLCache(1, cache_ttl)
+    public_keys_lock = Lock()
+    auth_server_cache: TTLCache = TTLCache(1, cache_ttl)
+    auth_server_lock = Lock()
+
+    @cached(public_keys_cache, key=lambda d: d["jwks_uri"], lock=public_keys_lock)
     def get_authentication_server_public_keys(OIDC_spec: Dict):
         """
         Retrieve the public keys used by the authentication server
         for signing OIDC ID tokens.
         """
         keys_uri = OIDC_spec["jwks_uri"]
-        r = requests.get(keys_uri)
+        r = session.get(keys_uri, timeout=timeout)
         keys = r.json()
         return keys
 
@@ -21,9 +53,9 @@ def configure(*_, cache_ttl: int):
         algos = OIDC_spec["id_token_signing_alg_values_supported"]
         return algos
 
-    @cached(TTLCache(1, cache_ttl), lock=Lock())
+    @cached(auth_server_cache, lock=auth_server_lock)
     def discover_auth_server(*_, openid_connect_url: str) -> Dict:
-        r = requests.get(openid_connect_url)
+        r = session.get(openid_connect_url, timeout=timeout)
         # Raise if the auth server is failing since we can't verify tokens
         r.raise_for_status()
         configuration = r.json()
@@ -38,6 +70,16 @@ def configure(*_, cache_ttl: int):
     def get_supported_scopes(OIDC_spec: Dict) -> str:
         return OIDC_spec["scopes_supported"]
 
+    def clear_cached_responses():
+        """
+        Forget the cached configuration and public keys so that the next
+        lookup goes to the authentication server.
+        """
+        with public_keys_lock:
+            public_keys_cache.clear()
+        with auth_server_lock:
+            auth_server_cache.clear()
+
     class functions:
         auth_server = discover_auth_server
         public_keys = get_authentication_server_public_keys
@@ -45,5 +87,6 @@ def configure(*_, cache_ttl: int):
         authorization_url = get_authorization_url
         token_url = get_token_url
         supported_scopes = get_supported_scopes
+        clear_cache = clear_cached_responses
 
     return functions
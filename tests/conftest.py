@@ -1,12 +1,15 @@
+import base64
 import json
 import os
 import time
 import uuid
 
 import jwt
+import jwt.algorithms
 import pytest
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures")
@@ -54,6 +57,35 @@ def public_key(key):
     )
 
 
+@pytest.fixture
+def key_id():
+    return "SoLongAndThanksForAllTheFish"
+
+
+@pytest.fixture
+def jwks(key, key_id):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    jwk["kid"] = key_id
+    return {"keys": [jwk]}
+
+
+@pytest.fixture
+def ec_key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+@pytest.fixture
+def ec_jwk(ec_key):
+    numbers = ec_key.public_key().public_numbers()
+    return {
+        "kty": "EC",
+        "crv": "P-256",
+        "kid": "ShortFuseOfTheDeadMansSwitch",
+        "x": base64.urlsafe_b64encode(numbers.x.to_bytes(32, "big")).decode(),
+        "y": base64.urlsafe_b64encode(numbers.y.to_bytes(32, "big")).decode(),
+    }
+
+
 @pytest.fixture
 def config_w_aud():
     return {
@@ -74,7 +106,7 @@ def no_audience_config():
 
 
 @pytest.fixture
-def token_with_audience(private_key, config_w_aud, test_email) -> str:
+def token_with_audience(private_key, key_id, config_w_aud, test_email) -> str:
     audience: str = str(config_w_aud["client_id"])
     issuer: str = str(config_w_aud["issuer"])
     now = int(time.time())
@@ -99,11 +131,12 @@ def token_with_audience(private_key, config_w_aud, test_email) -> str:
         },
         private_key,
         algorithm="RS256",
-    ).decode("UTF-8")
+        headers={"kid": key_id},
+    )
 
 
 @pytest.fixture
-def token_without_audience(private_key, no_audience_config, test_email) -> str:
+def token_without_audience(private_key, key_id, no_audience_config, test_email) -> str:
     # Make a token where audience is client_id
     issuer: str = str(no_audience_config["issuer"])
     now = int(time.time())
@@ -128,17 +161,19 @@ def token_without_audience(private_key, no_audience_config, test_email) -> str:
         },
         private_key,
         algorithm="RS256",
-    ).decode("UTF-8")
+        headers={"kid": key_id},
+    )
 
 
 @pytest.fixture
-def mock_discovery(oidc_discovery, public_key):
+def mock_discovery(oidc_discovery, jwks):
     class functions:
         auth_server = lambda **_: oidc_discovery
-        public_keys = lambda _: public_key
+        public_keys = lambda _: jwks
         signing_algos = lambda x: x["id_token_signing_alg_values_supported"]
         authorization_url = lambda x: x["authorization_endpoint"]
         token_url = lambda x: x["token_endpoint"]
         supported_scopes = lambda x: x["scopes_supported"]
+        clear_cache = lambda: None
 
     return lambda *args, **kwargs: functions
@@ -1,8 +1,18 @@
+import base64
+import time
+
+import jwt
+import pytest
+import requests
+from fastapi import Depends
+from fastapi import FastAPI
+from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import SecurityScopes
 
 import fastapi_third_party_auth
 from fastapi_third_party_auth import Auth
+from fastapi_third_party_auth import GrantType
 from fastapi_third_party_auth.idtoken_types import IDToken
 
 
@@ -82,3 +92,460 @@ def test__authenticate_user_returns_custom_tokens(
     )
 
     assert custom_token.custom_field == "OnlySlightlyBent"
+
+
+def test__authenticate_user_reuses_discovery(
+    monkeypatch, mock_discovery, oidc_discovery, token_with_audience, config_w_aud
+):
+    calls = []
+
+    def auth_server(**kwargs):
+        calls.append(kwargs)
+        return oidc_discovery
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+    for _ in range(3):
+        auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+
+    assert len(calls) == 1
+
+
+def test__find_key_raises_on_unknown_kid(
+    monkeypatch, mock_discovery, jwks, token_with_audience, config_w_aud
+):
+    jwks["keys"][0]["kid"] = "ShootFirstAskQuestionsLater"
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+
+    with pytest.raises(jwt.InvalidTokenError):
+        auth._find_key(token_with_audience.encode())
+
+
+def test__authenticate_user_caches_verified_tokens(
+    monkeypatch, mock_discovery, token_with_audience, config_w_aud
+):
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    decode = jwt.decode
+    calls = []
+
+    def counting_decode(token, *args, **kwargs):
+        calls.append(token)
+        return decode(token, *args, **kwargs)
+
+    monkeypatch.setattr(jwt, "decode", counting_decode)
+
+    auth = Auth(**config_w_aud, verification_cache_ttl=10)
+
+    for _ in range(3):
+        id_token = auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+
+    assert id_token.aud == config_w_aud["client_id"]
+    assert len(calls) == 1
+
+
+def test__unverified_header(token_with_audience, key_id):
+    header = fastapi_third_party_auth.auth._unverified_header(
+        token_with_audience.encode()
+    )
+
+    assert header["kid"] == key_id
+    assert header["alg"] == "RS256"
+
+
+def test__unverified_header_raises_on_garbage():
+    with pytest.raises(jwt.DecodeError):
+        fastapi_third_party_auth.auth._unverified_header(b"MostlyHarmless")
+
+
+def test__authenticate_user_enforces_jwk_alg(
+    monkeypatch, mock_discovery, jwks, token_with_audience, config_w_aud
+):
+    jwks["keys"][0]["alg"] = "RS512"
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+
+    with pytest.raises(HTTPException) as error:
+        auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+    assert error.value.status_code == 401
+
+
+def test__flows_are_discovered_lazily(
+    monkeypatch, mock_discovery, oidc_discovery, config_w_aud
+):
+    calls = []
+
+    def auth_server(**kwargs):
+        calls.append(kwargs)
+        return oidc_discovery
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+    app = FastAPI(dependencies=[Depends(auth)])
+
+    @app.get("/")
+    def index():
+        return None
+
+    assert len(calls) == 0
+
+    schema = app.openapi()
+    assert len(calls) == 1
+    assert (
+        schema["components"]["securitySchemes"]["OIDC"]["flows"]["implicit"][
+            "authorizationUrl"
+        ]
+        == oidc_discovery["authorization_endpoint"]
+    )
+
+
+def test__flows_from_static_urls_skip_discovery(
+    monkeypatch, mock_discovery, config_w_aud
+):
+    def auth_server(**_):
+        raise AssertionError("Discovery should not be needed")
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(
+        **config_w_aud,
+        grant_types=[GrantType.AUTHORIZATION_CODE],
+        authorization_url="ThePrimeMoverOfAllThings",
+        token_url="JustReadTheInstructions",
+    )
+
+    flows = auth.model.flows
+    assert flows.authorizationCode.authorizationUrl == "ThePrimeMoverOfAllThings"
+    assert flows.authorizationCode.tokenUrl == "JustReadTheInstructions"
+
+
+def test__authenticate_user_requires_scopes(
+    monkeypatch, mock_discovery, token_with_audience, config_w_aud
+):
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+
+    with pytest.raises(HTTPException) as error:
+        auth.required(
+            security_scopes=SecurityScopes(scopes=["email"]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+    assert error.value.status_code == 401
+    assert "['email']" in error.value.detail
+
+
+def test__find_key_refreshes_on_unknown_kid(
+    monkeypatch, mock_discovery, jwks, key_id, token_with_audience, config_w_aud
+):
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    jwks["keys"][0]["kid"] = "ShootFirstAskQuestionsLater"
+    auth = Auth(**config_w_aud)
+    assert key_id not in auth._keys_by_kid
+
+    # The auth server rotates its keys after we last fetched them
+    jwks["keys"][0]["kid"] = key_id
+    fetched_at, oidc_discoveries = auth._discovery_cache
+    auth._discovery_cache = (
+        fetched_at - fastapi_third_party_auth.auth.UNKNOWN_KID_REFRESH_INTERVAL,
+        oidc_discoveries,
+    )
+
+    jwk, _, _ = auth._find_key(token_with_audience.encode())
+    assert jwk["kid"] == key_id
+
+
+def test__get_discoveries_refreshes_stale_in_background(
+    monkeypatch, mock_discovery, oidc_discovery, config_w_aud
+):
+    calls = []
+
+    def auth_server(**kwargs):
+        calls.append(kwargs)
+        return oidc_discovery
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud, signature_stale_ttl=60)
+    auth._get_discoveries()
+    fetched_at, _ = auth._discovery_cache
+    stale_discovery = {"stale": True}
+    auth._discovery_cache = (fetched_at - auth.signature_cache_ttl, stale_discovery)
+
+    assert auth._get_discoveries() is stale_discovery
+
+    assert auth._background_refresh_lock.acquire(timeout=5)
+    assert len(calls) == 2
+    assert auth._get_discoveries() is oidc_discovery
+
+
+def test__authenticate_user_fails_fast_after_auth_server_outage(
+    monkeypatch, mock_discovery, token_with_audience, config_w_aud
+):
+    calls = []
+
+    def auth_server(**kwargs):
+        calls.append(kwargs)
+        raise requests.exceptions.ConnectionError("TheEndOfTheUniverse")
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud, discovery_retry_interval=60)
+    for _ in range(3):
+        with pytest.raises(HTTPException) as error:
+            auth.required(
+                security_scopes=SecurityScopes(scopes=[]),
+                authorization_credentials=HTTPAuthorizationCredentials(
+                    scheme="Bearer", credentials=token_with_audience
+                ),
+            )
+        assert error.value.status_code == 503
+
+    assert len(calls) == 1
+
+
+def test__find_key_rejects_non_string_kid(monkeypatch, mock_discovery, config_w_aud):
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+    header = base64.urlsafe_b64encode(b'{"alg": "RS256", "kid": ["k1"]}')
+
+    with pytest.raises(jwt.InvalidTokenError):
+        auth._find_key(header.rstrip(b"=") + b".e30.")
+
+
+def test__authenticate_user_maps_key_errors_to_401(
+    monkeypatch, mock_discovery, token_with_audience, config_w_aud
+):
+    def decode(*args, **kwargs):
+        raise jwt.exceptions.InvalidKeyError("ItsCharacterForming")
+
+    monkeypatch.setattr(jwt, "decode", decode)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+
+    with pytest.raises(HTTPException) as error:
+        auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+    assert error.value.status_code == 401
+
+
+def test__authenticate_user_rejects_alg_outside_key_family(
+    monkeypatch, mock_discovery, oidc_discovery, key_id, config_w_aud
+):
+    oidc_discovery["id_token_signing_alg_values_supported"] = ["HS256", "RS256"]
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+    now = int(time.time())
+    token = jwt.encode(
+        {
+            "aud": config_w_aud["client_id"],
+            "iss": config_w_aud["issuer"],
+            "sub": "foo",
+            "exp": now + 30,
+            "iat": now,
+        },
+        "IThoughtYouMightBeSomeoneElse",
+        algorithm="HS256",
+        headers={"kid": key_id},
+    )
+
+    auth = Auth(**config_w_aud)
+
+    with pytest.raises(HTTPException) as error:
+        auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token
+            ),
+        )
+    assert error.value.status_code == 401
+
+
+def test__flows_are_rediscovered_after_a_failure(
+    monkeypatch, mock_discovery, oidc_discovery, config_w_aud
+):
+    responses = [requests.exceptions.ConnectionError("Uncomfortable"), oidc_discovery]
+
+    def auth_server(**_):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(mock_discovery(), "auth_server", auth_server)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud, discovery_retry_interval=0)
+
+    assert auth.model.flows.implicit is None
+    assert (
+        auth.model.flows.implicit.authorizationUrl
+        == oidc_discovery["authorization_endpoint"]
+    )
+
+
+def test__authenticate_user_keeps_stale_keys_when_jwks_fetch_fails(
+    monkeypatch, mock_discovery, jwks, token_with_audience, config_w_aud
+):
+    calls = []
+
+    def public_keys(_):
+        calls.append(_)
+        if len(calls) > 1:
+            raise requests.exceptions.ConnectionError("GunboatDiplomat")
+        return jwks
+
+    monkeypatch.setattr(mock_discovery(), "public_keys", public_keys)
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud, signature_stale_ttl=60)
+    keys_by_kid = auth._keys_by_kid
+    fetched_at, oidc_discoveries = auth._discovery_cache
+    auth._discovery_cache = (fetched_at - auth.signature_cache_ttl, oidc_discoveries)
+
+    for _ in range(2):
+        id_token = auth.required(
+            security_scopes=SecurityScopes(scopes=[]),
+            authorization_credentials=HTTPAuthorizationCredentials(
+                scheme="Bearer", credentials=token_with_audience
+            ),
+        )
+        assert id_token.aud == config_w_aud["client_id"]
+        assert auth._background_refresh_lock.acquire(timeout=5)
+        auth._background_refresh_lock.release()
+
+    assert len(calls) == 2
+    assert auth._keys_cache is keys_by_kid
+
+
+def test__authenticate_user_skips_jwks_that_fail_to_load(
+    monkeypatch,
+    mock_discovery,
+    jwks,
+    ec_jwk,
+    key_id,
+    token_with_audience,
+    config_w_aud,
+):
+    bad_jwk = dict(jwks["keys"][0], kid="ProgrammableMatter", n="!")
+    jwks["keys"] = [ec_jwk, bad_jwk, *jwks["keys"]]
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+
+    auth = Auth(**config_w_aud)
+    id_token = auth.required(
+        security_scopes=SecurityScopes(scopes=[]),
+        authorization_credentials=HTTPAuthorizationCredentials(
+            scheme="Bearer", credentials=token_with_audience
+        ),
+    )
+
+    assert id_token.aud == config_w_aud["client_id"]
+    assert key_id in auth._keys_cache
+    assert "ProgrammableMatter" not in auth._keys_cache
+    assert auth.model.flows is not None
+
+
+def test__authenticate_user_verifies_ec_signed_tokens(
+    monkeypatch,
+    mock_discovery,
+    oidc_discovery,
+    jwks,
+    ec_key,
+    ec_jwk,
+    config_w_aud,
+    test_email,
+):
+    jwks["keys"] = [ec_jwk]
+    oidc_discovery["id_token_signing_alg_values_supported"] = ["ES256"]
+    monkeypatch.setattr(
+        fastapi_third_party_auth.auth.discovery, "configure", mock_discovery
+    )
+    now = int(time.time())
+    token = jwt.encode(
+        {
+            "aud": config_w_aud["client_id"],
+            "iss": config_w_aud["issuer"],
+            "email": test_email,
+            "sub": "foo",
+            "exp": now + 30,
+            "iat": now,
+        },
+        ec_key,
+        algorithm="ES256",
+        headers={"kid": ec_jwk["kid"]},
+    )
+
+    auth = Auth(**config_w_aud)
+    id_token = auth.required(
+        security_scopes=SecurityScopes(scopes=[]),
+        authorization_credentials=HTTPAuthorizationCredentials(
+            scheme="Bearer", credentials=token
+        ),
+    )
+
+    assert id_token.email == test_email